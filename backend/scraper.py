@@ -1,11 +1,19 @@
 import os
 import sys
+import re
 import datetime
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree, html as lxml_html
 from supabase import create_client, Client
 import tweepy
 import time
+import queue
+import threading
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration ---
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
@@ -18,6 +26,43 @@ TWITTER_ACCESS_SECRET = os.environ.get("TWITTER_ACCESS_SECRET")
 # Timezone: JST
 JST = datetime.timezone(datetime.timedelta(hours=9))
 
+# --- HTTP ---
+# Shared across the whole run so keep-alive connections to netkeiba are reused.
+USER_AGENT = "Mozilla/5.0 (compatible; OddsAestheticBot/1.0)"
+HTTP_HEADERS = {
+    "User-Agent": USER_AGENT,
+    "Accept-Encoding": "gzip, deflate"
+}
+
+SESSION = requests.Session()
+SESSION.headers.update(HTTP_HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+))
+
+# --- Odds page XPaths (compiled once) ---
+# Class tests mirror CSS ".Name" matching (whole class token, not substring).
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+RACE_NAME_XPATH = etree.XPath(f"normalize-space(//*[{_has_class('RaceName')}])")
+ROW_XPATH = etree.XPath(f"//*[@id='Odds_Design_Table']//tr[{_has_class('HorseList')}]")
+WAKU_XPATH = etree.XPath(f"normalize-space(.//*[{_has_class('Waku')}])")
+HORSE_NAME_XPATH = etree.XPath(f"normalize-space(.//*[{_has_class('Horse_Name')}])")
+ODDS_XPATH = etree.XPath(f"normalize-space(.//*[{_has_class('Odds')}])")
+
+# --- Race list XPaths ---
+# Jump races (障害レース) are excluded in the XPath itself:
+# netkeiba's .RaceData01 reads like "芝1600m" or "障3000m"
+RACE_ITEM_XPATH = etree.XPath(
+    f"//*[{_has_class('RaceList_DataItem')}]"
+    f"[not(.//*[{_has_class('RaceData01')}][contains(., '障')])]"
+)
+RACE_HREF_XPATH = etree.XPath("string((.//a)[1]/@href)")
+RACE_TIME_XPATH = etree.XPath(f"normalize-space(.//*[{_has_class('RaceTime')}])")
+
 def get_supabase() -> Client:
     if not SUPABASE_URL or not SUPABASE_KEY:
         print("Error: Supabase credentials not found.")
@@ -36,152 +81,270 @@ def get_twitter_client():
         access_token_secret=TWITTER_ACCESS_SECRET
     )
 
-def scrape_race_odds(rid, current_time):
+def tweet_worker(twitter, tweet_queue):
+    """
+    Posts queued alert messages until a None sentinel is received.
+    """
+    while True:
+        msg = tweet_queue.get()
+        if msg is None:
+            break
+        try:
+            twitter.create_tweet(text=msg)
+        except: pass
+
+def parse_fragment(content, marker, encoding):
+    """
+    Parses only the element whose opening tag contains marker. returns None if it can't be located.
+    """
+    # The fragment loses the page's <meta charset>, so the encoding must come from the response
+    if not encoding: return None
+
+    pos = content.find(marker)
+    if pos < 0: return None
+    start = content.rfind(b'<', 0, pos)
+    if start < 0: return None
+
+    tag = content[start + 1:pos].split(None, 1)[0]
+
+    # Walk open/close tags of the same name so nested elements (e.g. <div> in <div>) don't cut it short
+    depth = 0
+    end = -1
+    for m in re.finditer(rb'<(/?)' + re.escape(tag) + rb'[\s>/]', content[start:], re.I):
+        depth += -1 if m.group(1) else 1
+        if depth == 0:
+            end = content.find(b'>', start + m.start()) + 1
+            break
+    if end <= 0: return None
+
+    parser = lxml_html.HTMLParser(encoding=encoding)
+    return lxml_html.fromstring(content[start:end], parser=parser)
+
+# Conditional GET cache: rid -> (etag, last_modified, data, title).
+# Burst mode re-fetches the same rids every tick; a 304 reuses the last parse.
+ODDS_CACHE = {}
+
+async def scrape_race_odds(session, rid):
     """
     Scrapes odds for a single race ID. returns list of dicts.
     """
     odds_url = f"https://race.netkeiba.com/odds/index.html?race_id={rid}"
+    headers = {}
+    cached = ODDS_CACHE.get(rid)
+    if cached:
+        etag, last_modified, _, _ = cached
+        if etag: headers["If-None-Match"] = etag
+        if last_modified: headers["If-Modified-Since"] = last_modified
+
     try:
-        r_odds = requests.get(odds_url, timeout=10)
-        s_odds = BeautifulSoup(r_odds.content, "html.parser")
+        async with session.get(odds_url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as r_odds:
+            if r_odds.status == 304 and cached:
+                return cached[2], cached[3]
+            # Error pages must not be parsed or become the cached validator
+            if r_odds.status != 200:
+                print(f"[{rid}] Fetch error: HTTP {r_odds.status}")
+                return [], None
+            html = await r_odds.read()
+            etag = r_odds.headers.get("ETag")
+            last_modified = r_odds.headers.get("Last-Modified")
+            encoding = r_odds.charset
+
+        # Parse just the title and odds table; fall back to the full page on any miss
+        try:
+            title_tree = parse_fragment(html, b'class="RaceName"', encoding)
+            table_tree = parse_fragment(html, b'id="Odds_Design_Table"', encoding)
+            r_title = RACE_NAME_XPATH(title_tree) if title_tree is not None else ""
+            rows = ROW_XPATH(table_tree) if table_tree is not None else []
+        except Exception:
+            r_title, rows = "", []
+        if not r_title or not rows:
+            tree = lxml_html.fromstring(html)
+            r_title = RACE_NAME_XPATH(tree)
+            rows = ROW_XPATH(tree)
     except Exception as e:
         print(f"[{rid}] Fetch error: {e}")
         return [], None
 
-    # Find Race Name/Info for Tweet
-    try:
-        r_title = s_odds.select_one(".RaceName").get_text(strip=True)
-    except:
-        r_title = f"Race {rid}"
+    # Race Name/Info for Tweet
+    r_title = r_title or f"Race {rid}"
 
     # Extract Odds Data
     data = []
-    rows = s_odds.select("#Odds_Design_Table tr.HorseList")
     for row in rows:
-        try:
-            h_num_elem = row.select_one(".Waku") 
-            h_name_elem = row.select_one(".Horse_Name")
-            odds_elem = row.select_one(".Odds") 
-            
-            if not (h_num_elem and h_name_elem and odds_elem):
-                continue
-                
-            h_num = int(h_num_elem.get_text(strip=True))
-            h_name = h_name_elem.get_text(strip=True)
-            odds_text = odds_elem.get_text(strip=True)
+        h_num_text = WAKU_XPATH(row)
+        h_name = HORSE_NAME_XPATH(row)
+        odds_text = ODDS_XPATH(row)
+        
+        # Explicit checks instead of try/except: "---" and other non-numeric odds are common
+        if not (h_num_text.isdecimal() and h_name):
+            continue
+        if not odds_text.replace(".", "", 1).isdecimal():
+            continue
             
-            if not odds_text or odds_text == "---":
-                continue
-                
-            current_odds = float(odds_text)
-            data.append({
-                "horse_number": h_num,
-                "horse_name": h_name,
-                "current_odds": current_odds
-            })
-        except:
-            pass
+        data.append({
+            "horse_number": int(h_num_text),
+            "horse_name": h_name,
+            "current_odds": float(odds_text)
+        })
     
+    if etag or last_modified:
+        ODDS_CACHE[rid] = (etag, last_modified, data, r_title)
+
     return data, r_title
 
-def check_and_alert(rid, data, r_title, supabase, twitter):
+# Process-local cache: rid -> race UUID. Burst mode re-checks the same rids every tick.
+RACE_UUID_CACHE = {}
+
+def get_race_uuid(supabase, rid):
+    """
+    Returns the internal UUID for a netkeiba race ID, creating a placeholder race if needed.
+    """
+    if rid in RACE_UUID_CACHE:
+        return RACE_UUID_CACHE[rid]
+
+    # Fetch or create in one call (see get_or_create_race in schema.sql)
+    # Placeholder details only apply when the race is new
+    res = supabase.rpc('get_or_create_race', {
+        "p_external_id": rid,
+        "p_race_date": datetime.datetime.now().strftime("%Y-%m-%d"),
+        "p_location": "JRA", # Should parse
+        "p_race_number": 0,  # Should parse
+        "p_start_time": datetime.datetime.now().isoformat() # Dummy
+    }).execute()
+    if res.data:
+        RACE_UUID_CACHE[rid] = res.data
+        return RACE_UUID_CACHE[rid]
+    return None
+
+# Last odds written per horse: (rid, horse_number) -> (odds, timestamp)
+LAST_ODDS = {}
+# Unchanged odds are still re-saved this often so the snapshot history keeps its time points
+SNAPSHOT_REFRESH_SEC = 60
+
+def needs_snapshot(rid, horse, now_ts):
+    last = LAST_ODDS.get((rid, horse['horse_number']))
+    if not last: return True
+    last_odds, last_ts = last
+    return last_odds != horse['current_odds'] or now_ts - last_ts >= SNAPSHOT_REFRESH_SEC
+
+def check_and_alert(rid, data, r_title, supabase, tweet_queue):
     """
-    Compares current odds with DB snapshots and alerts if dropped.
+    Saves the current odds; the detect_drop trigger records any drops in odds_analysis.
+    Alerts found for this batch are then tweeted.
     """
     if not data: return
 
-    for horse in data:
-        # Fetch previous snapshot (Mocking logic for MVP: in prod, use race_id UUID)
-        # Using a simple logic: Check latest snapshot for this race_id + horse_num
-        # We need to find the internal UUID of the race first. 
-        # For efficiency in this loop, we might want to cache the race UUID.
-        
-        # 1. Get Race UUID (create if not exists or assume seed_data)
-        # For MVP: We skip complex DB sync and assume we can query by some key or just insert analysis directly.
-        # Let's try to query 'races' by external_id={rid}
-        
-        # NOTE: Proper implementation requires 'races' table sync. 
-        # Here we do a simplified check: Just Insert to snapshots and Compare.
-        
-        # Need to fix the Relation: id (UUID) <-> rid (String like 2024...)
-        # Assume 'races' has external_id.
-        
-        # Fetch or Create Race
-        race_res = supabase.table('races').select('id').eq('external_id', rid).execute()
-        race_uuid = None
-        if race_res.data:
-            race_uuid = race_res.data[0]['id']
-        else:
-            # Create race placeholder
-            # Need to parse details, but for MVP let's insert minimal
-            new_race = {
-                "external_id": rid,
-                "race_date": datetime.datetime.now().strftime("%Y-%m-%d"), 
-                "location": "JRA", # Should parse
-                "race_number": 0,  # Should parse
-                "start_time": datetime.datetime.now().isoformat() # Dummy
-            }
-            res = supabase.table('races').insert(new_race).execute()
-            if res.data: race_uuid = res.data[0]['id']
-
-        if not race_uuid: continue
-
-        # 2. Get Last Snapshot
-        snap_res = supabase.table('odds_snapshots')\
-            .select('odds')\
-            .eq('race_id', race_uuid)\
-            .eq('horse_number', horse['horse_number'])\
-            .order('fetched_at', desc=True)\
-            .limit(1)\
-            .execute()
-            
-        previous_odds = None
-        if snap_res.data:
-            previous_odds = snap_res.data[0]['odds']
-
-        # 3. Detect Drop
-        if previous_odds:
-            if previous_odds > 0:
-                drop_rate = (previous_odds - horse['current_odds']) / previous_odds
-                if drop_rate >= 0.2: # 20% drop
-                    print(f"ALERT: {horse['horse_name']} {previous_odds} -> {horse['current_odds']}")
-                    
-                    # Record Analysis
-                    supabase.table('odds_analysis').insert({
-                        "race_id": race_uuid,
-                        "horse_number": horse['horse_number'],
-                        "horse_name": horse['horse_name'],
-                        "previous_odds": previous_odds,
-                        "current_odds": horse['current_odds'],
-                        "drop_rate": drop_rate
-                    }).execute()
-
-                    # Tweet
-                    if twitter:
-                        msg = f"【急落検知】\n{r_title} {horse['horse_number']}番 {horse['horse_name']}\n{previous_odds} → {horse['current_odds']} (▼{drop_rate*100:.1f}%)\n#JRA #競馬 #OddsAesthetic"
-                        try:
-                            twitter.create_tweet(text=msg)
-                        except: pass
-
-        # 4. Save Snapshot (Always, for next comparison)
-        supabase.table('odds_snapshots').insert({
-            "race_id": race_uuid,
-            "horse_number": horse['horse_number'],
-            "odds": horse['current_odds']
-        }).execute()
+    # 1. Get Race UUID (once per race, not per horse)
+    # 'races' is keyed by external_id={rid}
+    race_uuid = get_race_uuid(supabase, rid)
+    if not race_uuid: return
+
+    # 2. Skip horses whose odds haven't moved since our last write (no drop possible),
+    # unless their last snapshot is older than SNAPSHOT_REFRESH_SEC
+    now_ts = time.time()
+    changed = [h for h in data if needs_snapshot(rid, h, now_ts)]
+    if not changed: return
+
+    # 3. Save Snapshots (one INSERT per race). Drop detection runs in Postgres.
+    snapshot_rows = [{
+        "race_id": race_uuid,
+        "horse_number": horse['horse_number'],
+        "horse_name": horse['horse_name'],
+        "odds": horse['current_odds']
+    } for horse in changed]
+    snap_res = supabase.table('odds_snapshots').insert(snapshot_rows).execute()
+    snapshot_ids = [snap['id'] for snap in (snap_res.data or [])]
+    if not snapshot_ids: return
+
+    for horse in changed:
+        LAST_ODDS[(rid, horse['horse_number'])] = (horse['current_odds'], now_ts)
 
+    # 4. Read back alerts the trigger recorded for this batch
+    alert_res = supabase.table('odds_analysis')\
+        .select('horse_number, horse_name, previous_odds, current_odds, drop_rate')\
+        .in_('snapshot_id', snapshot_ids)\
+        .execute()
+
+    for alert in (alert_res.data or []):
+        print(f"ALERT: {alert['horse_name']} {alert['previous_odds']} -> {alert['current_odds']}")
+
+        # Tweet (sent by tweet_worker, off the scraping path)
+        if tweet_queue:
+            msg = f"【急落検知】\n{r_title} {alert['horse_number']}番 {alert['horse_name']}\n{alert['previous_odds']} → {alert['current_odds']} (▼{alert['drop_rate']*100:.1f}%)\n#JRA #競馬 #OddsAesthetic"
+            tweet_queue.put(msg)
+
+
+async def scrape_and_alert(session, rid, supabase, tweet_queue):
+    """
+    Fetches one race and runs the drop check on it as soon as its odds arrive.
+    """
+    data, title = await scrape_race_odds(session, rid)
+    # Supabase calls are blocking; run them on the loop's thread pool so races overlap
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, check_and_alert, rid, data, title, supabase, tweet_queue)
+
+async def burst_mode(session, urgent_races, supabase, tweet_queue):
+    """
+    Polls urgent races every 10 seconds until they all start.
+    The sleep runs alongside the fetches, so a tick takes max(fetch, 10s).
+    """
+    print(">>> Entering Burst Mode <<<")
+    # Loop until the latest start time in urgent_races passes
+    # Max loop duration cap: 120 seconds to prevent overrun
+    start_loop = time.time()
+
+    while True:
+        # Check timeout
+        if time.time() - start_loop > 120:
+            print("Burst timeout.")
+            break
+
+        now_jst = datetime.datetime.now(JST)
+        active_urgent = [r for r in urgent_races if r['start_time'] > now_jst]
+        if not active_urgent:
+            print("All races started.")
+            break
+
+        print(f"BURST Fetch: {', '.join(ur['rid'] for ur in active_urgent)}")
+        await asyncio.gather(
+            *(scrape_and_alert(session, ur['rid'], supabase, tweet_queue) for ur in active_urgent),
+            asyncio.sleep(10) # 10 sec interval for Real-time (Active/Aggressive)
+        )
+
+async def run_strategy(candidates, urgent_races, supabase, tweet_queue):
+    """
+    Normal fetch for all candidates, then burst polling for urgent races.
+    One ClientSession is kept open for both phases.
+    """
+    # Worker threads for check_and_alert (see scrape_and_alert)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=8))
+
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20),
+        headers=HTTP_HEADERS
+    ) as session:
+        # A) Immediate Fetch for ALL Candidates (Covers the 'Every 2 mins' requirement efficiently)
+        # Since we run every 5 mins, fetching once ensures reasonably fresh data for the 15-min window.
+        print(f"Fetching normal: {', '.join(candidates)}")
+        await asyncio.gather(*(scrape_and_alert(session, rid, supabase, tweet_queue) for rid in candidates))
+
+        # B) Burst Mode for Urgent Races
+        # If a race is starting soon, we stick around and poll until it starts.
+        if urgent_races:
+            await burst_mode(session, urgent_races, supabase, tweet_queue)
 
 def main():
     now = datetime.datetime.now(JST)
     date_str = now.strftime("%Y%m%d")
+    today_midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
     
     print(f"--- Run at {now} ---")
 
     # 1. Fetch Race List
     list_url = f"https://race.netkeiba.com/top/race_list.html?kaisai_date={date_str}"
     try:
-        resp = requests.get(list_url)
-        soup = BeautifulSoup(resp.content, "html.parser")
+        resp = SESSION.get(list_url, timeout=10)
+        tree = lxml_html.fromstring(resp.content)
     except Exception as e:
         print(e)
         sys.exit(0)
@@ -193,35 +356,23 @@ def main():
     candidates = [] # Races we want to process
     urgent_races = [] # Races starting in < 2 mins (Burst Mode)
     
-    # Simple iteration over race links
-    race_items = soup.select(".RaceList_DataItem")
-    
-    for item in race_items:
+    # Simple iteration over race links (jump races already filtered out)
+    for item in RACE_ITEM_XPATH(tree):
         try:
             # Extract ID
-            link = item.select_one("a")
-            if not link: continue
-            href = link.get("href")
+            href = RACE_HREF_XPATH(item)
+            if not href: continue
             rid = href.split("race_id=")[1].split("&")[0]
-            
-            # Filter: Exclude Jump Races (障害レース)
-            # Netkeiba usually has .RaceData01 with text like "芝1600m" or "障3000m"
-            race_data_node = item.select_one(".RaceData01")
-            if race_data_node:
-                r_txt = race_data_node.get_text(strip=True)
-                if "障" in r_txt:
-                    # print(f"Skipping Jump Race: {rid}")
-                    continue
 
             # Extract Time (e.g., "10:30")
-            time_elem = item.select_one(".RaceTime")
-            if not time_elem: continue
-            time_str = time_elem.get_text(strip=True)
+            time_str = RACE_TIME_XPATH(item)
+            if not time_str: continue
             
             # Parse Time
             # time_str is HH:MM. Join with today's date
             # Handling 10:00 vs 09:55
-            dst_dt = datetime.datetime.strptime(f"{date_str} {time_str}", "%Y%m%d %H:%M").replace(tzinfo=JST)
+            hh, mm = time_str.split(":")
+            dst_dt = today_midnight.replace(hour=int(hh), minute=int(mm))
             
             # Logic:
             # Window starts: 15 mins before race
@@ -255,40 +406,21 @@ def main():
     supabase = get_supabase()
     twitter = get_twitter_client()
 
+    # Tweets go through a background thread so Twitter latency never delays a fetch
+    tweet_queue = None
+    if twitter:
+        tweet_queue = queue.Queue()
+        worker = threading.Thread(target=tweet_worker, args=(twitter, tweet_queue), daemon=True)
+        worker.start()
+
     # 3. Strategy Execution
-    
-    # A) Immediate Fetch for ALL Candidates (Covers the 'Every 2 mins' requirement efficiently)
-    # Since we run every 5 mins, fetching once ensures reasonably fresh data for the 15-min window.
-    for rid in candidates:
-        print(f"Fetching normal: {rid}")
-        data, title = scrape_race_odds(rid, now)
-        check_and_alert(rid, data, title, supabase, twitter)
-
-    # B) Burst Mode for Urgent Races
-    # If a race is starting soon, we stick around and poll until it starts.
-    if urgent_races:
-        print(">>> Entering Burst Mode <<<")
-        # Loop until the latest start time in urgent_races passes
-        # Max loop duration cap: 120 seconds to prevent overrun
-        start_loop = time.time()
-        
-        while True:
-            # Check timeout
-            if time.time() - start_loop > 120: 
-                print("Burst timeout.")
-                break
-                
-            active_urgent = [r for r in urgent_races if (r['start_time'] - datetime.datetime.now(JST)).total_seconds() > 0]
-            if not active_urgent:
-                print("All races started.")
-                break
-                
-            for ur in active_urgent:
-                print(f"BURST Fetch: {ur['rid']}")
-                data, title = scrape_race_odds(ur['rid'], now)
-                check_and_alert(ur['rid'], data, title, supabase, twitter)
-            
-            time.sleep(10) # 10 sec interval for Real-time (Active/Aggressive)
+    try:
+        asyncio.run(run_strategy(candidates, urgent_races, supabase, tweet_queue))
+    finally:
+        # Drain pending tweets before exiting, even if a race failed
+        if tweet_queue:
+            tweet_queue.put(None)
+            worker.join()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,61 @@
+-- Functions and triggers used by the scraper.
+-- Safe to re-run: functions use "create or replace", the trigger is dropped first.
+-- Run after schema.sql (new databases) or upgrade.sql (existing ones).
+
+-- 1. Drop Detection Trigger
+-- Compares each new snapshot with the previous one for the same horse
+-- and records an alert when odds fell by 20% or more.
+create or replace function detect_drop()
+returns trigger
+language plpgsql
+as $$
+declare
+  prev_odds numeric(10, 2);
+  rate numeric;
+begin
+  select s.odds into prev_odds
+  from odds_snapshots s
+  where s.race_id = new.race_id
+    and s.horse_number = new.horse_number
+    and s.id <> new.id
+  order by s.fetched_at desc
+  limit 1;
+
+  if prev_odds is not null and prev_odds > 0 then
+    rate := (prev_odds - new.odds) / prev_odds;
+    if rate >= 0.2 then
+      insert into odds_analysis (race_id, horse_number, horse_name, previous_odds, current_odds, drop_rate, snapshot_id)
+      values (new.race_id, new.horse_number, coalesce(new.horse_name, ''), prev_odds, new.odds, rate, new.id);
+    end if;
+  end if;
+
+  return new;
+end;
+$$;
+
+drop trigger if exists trg_detect_drop on odds_snapshots;
+create trigger trg_detect_drop
+after insert on odds_snapshots
+for each row execute function detect_drop();
+
+-- 2. Get-or-Create Race (RPC)
+-- Single round-trip lookup by external_id; the no-op update makes RETURNING
+-- yield the id on conflict without overwriting the existing row.
+create or replace function get_or_create_race(
+  p_external_id text,
+  p_race_date date,
+  p_location text,
+  p_race_number integer,
+  p_start_time timestamp with time zone
+)
+returns uuid
+language sql
+as $$
+  insert into races (external_id, race_date, location, race_number, start_time)
+  values (p_external_id, p_race_date, p_location, p_race_number, p_start_time)
+  on conflict (external_id) do update set external_id = excluded.external_id
+  returning id;
+$$;
+
+-- 3. Make PostgREST pick up the new functions
+notify pgrst, 'reload schema';
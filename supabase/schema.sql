@@ -25,6 +25,7 @@ create table odds_analysis (
   previous_odds numeric(10, 2), -- The odds from the previous check
   current_odds numeric(10, 2) not null,
   drop_rate numeric(5, 4) not null, -- e.g., 0.20 for 20%
+  snapshot_id uuid, -- the odds_snapshots row that triggered this alert
   detected_at timestamp with time zone default now()
 );
 
@@ -34,6 +35,7 @@ create table odds_snapshots (
   id uuid primary key default uuid_generate_v4(),
   race_id uuid references races(id) on delete cascade,
   horse_number integer not null,
+  horse_name text,
   odds numeric(10, 2) not null,
   fetched_at timestamp with time zone default now()
 );
@@ -41,3 +43,9 @@ create table odds_snapshots (
 -- Indexing for performance
 create index idx_races_date on races(race_date);
 create index idx_snapshots_lookup on odds_snapshots(race_id, horse_number, fetched_at desc);
+
+create index idx_analysis_snapshot on odds_analysis(snapshot_id);
+
+-- 4. Functions & Triggers
+-- detect_drop / trg_detect_drop and get_or_create_race live in functions.sql
+-- (re-runnable). Run it after this file.
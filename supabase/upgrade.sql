@@ -0,0 +1,13 @@
+-- Upgrade for databases created from an earlier schema.sql
+-- Adds the columns the scraper depends on. Safe to re-run.
+-- Run functions.sql afterwards for the drop trigger and get_or_create_race.
+
+-- 1. New Columns
+alter table odds_snapshots add column if not exists horse_name text;
+alter table odds_analysis add column if not exists snapshot_id uuid;
+
+-- 2. Indexes
+create index if not exists idx_analysis_snapshot on odds_analysis(snapshot_id);
+
+-- 3. Make PostgREST pick up the new columns
+notify pgrst, 'reload schema';